@@ -21,7 +21,8 @@ Functions:
 import sys
 import argparse
 
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QShortcut, QKeySequence
 from util.display import EccentricityMapping, PolarAngleMapping
 from util import logger, config
 
@@ -54,40 +55,15 @@ if __name__ == "__main__":
     if namespace.polarAngle:
         mapping = PolarAngleMapping(namespace.debug)
 
-    # Setup the mapping into the main_loop
+    # Setup the mapping into the main_loop,
+    # the window is activated to receive the key shortcuts.
     mapping.window.show()
+    mapping.window.activateWindow()
 
     # Start the main loop if not waiting for start key press
     if not namespace.wait:
         mapping.main_loop()
 
-    def _on_timeout():
-        mapping.repaint()
-
-    def _on_key_pressed(event):
-        '''
-        Handle the key pressed event.
-
-        Args:
-            - event: The pressed event.
-        '''
-
-        try:
-            key = event.key()
-            enum = Qt.Key(key)
-            logger.debug(f'Key pressed: {key}, {enum.name}')
-
-            # The quite key is pressed, quit the app
-            if enum.name == config.control.quitKeyName:
-                mapping.app.quit()
-
-            # The start key is pressed, start the main loop
-            if namespace.wait and enum.name == config.control.startKeyName:
-                mapping.main_loop()
-
-        except Exception as err:
-            logger.error(f'Key pressed but I got an error: {err}')
-
     def _about_to_quit():
         '''
         Safely quit
@@ -96,16 +72,20 @@ if __name__ == "__main__":
         logger.debug('Safely quit the application')
         return
 
-    # Bind the _about_to_quit and _on_key_pressed methods
+    # Bind the _about_to_quit method
     mapping.app.aboutToQuit.connect(_about_to_quit)
-    mapping.window.keyPressEvent = _on_key_pressed
-
-    # Bind to the timer and run
-    timer = QTimer()
-    timer.timeout.connect(_on_timeout)
-    timer.start()
 
-    # Proper exit
+    # Bind the key shortcuts, they are dispatched by Qt.
+    # The quit key quits the app,
+    # and the start key starts the main loop if waiting for it.
+    quit_shortcut = QShortcut(QKeySequence(Qt.Key[config.control.quitKeyName].value),
+                              mapping.window, activated=mapping.app.quit)
+    if namespace.wait:
+        start_shortcut = QShortcut(QKeySequence(Qt.Key[config.control.startKeyName].value),
+                                   mapping.window, activated=mapping.main_loop)
+
+    # Proper exit.
+    # The mapping repaints by its own timer since the main loop starts.
     sys.exit(mapping.app.exec())
 
 # %% ---- 2024-10-28 ------------------------
@@ -20,25 +20,25 @@ Functions:
 # Requirements and constants
 import sys
 import time
-import contextlib
+import queue
 
 import numpy as np
 
-from PIL import Image, ImageDraw
-from PIL.ImageQt import ImageQt
+from PIL import Image, ImageColor
 
-from PyQt6.QtGui import QPixmap
-from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QPixmap, QImage
+from PyQt6.QtCore import Qt, QTimer
 from PyQt6.QtWidgets import QMainWindow, QApplication, QLabel
 
-from rich import print
-from threading import Thread, RLock
+from threading import Thread
 
 from . import logger, config, current_dir
+from .rasterize import fill_ring, fill_polar
 
 # %% ---- 2024-10-28 ------------------------
 # Function and class
-app = QApplication(sys.argv)
+# Reuse the running QApplication, there is only one per process
+app = QApplication.instance() or QApplication(sys.argv)
 logger.debug(f'App: {app}')
 
 screen = app.screens()[config.display.screenId]
@@ -58,18 +58,185 @@ class OnScreenDisplay(object):
 
     running = False
 
-    _rlock = RLock()
+    # The size of the sin lookup table, it is the power of 2
+    sin_lut_size = 1024
 
     def __init__(self):
         self._prepare_window()
+        self._prepare_buffer()
+        self._prepare_flicking()
+        self._prepare_timer()
         logger.info(f'Initialized {self}')
 
+    def _prepare_timer(self):
+        """
+        Prepare the timer repainting the display at the screen's refresh rate.
+        It is the precise timer, so the repaints do not drift by the coarse timer's 5% slack.
+
+        The timer is created and connected only once,
+        it is started by the main_loop and stopped by the stop_running.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        self._repaint_timer = QTimer()
+        self._repaint_timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._repaint_timer.setInterval(int(1000 / self.screen.refreshRate()))
+        self._repaint_timer.timeout.connect(self.repaint)
+
+    def _prepare_flicking(self):
+        """
+        Prepare the lookup table of the flicking colors.
+
+        The sin functional of one flicking period is quantized into the sin_lut_size phases,
+        so the colors are looked up instead of computed every frame.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        phase = np.linspace(0, 2*np.pi, self.sin_lut_size, endpoint=False)
+        self._sin_lut = ((np.sin(phase)+1)*0.5*255).astype(np.uint8)
+        # The lookup table phases per second
+        self._flicking_step = config.checkboxTexture.flickingRate * self.sin_lut_size
+
+    def flicking_colors(self, t: float) -> tuple:
+        """
+        Get the flicking colors at the time (t).
+
+        Parameters:
+        t (float): The current time in seconds.
+
+        Returns:
+        tuple: The color value (v) of the sin functional, and u is its reverse.
+        """
+        k = int(self._flicking_step * t)
+        v = int(self._sin_lut[k & (self.sin_lut_size-1)])
+        return v, 255-v
+
+    def _prepare_buffer(self):
+        """
+        Prepare the double persistent RGBA buffers and their QImages.
+
+        The generate_img method writes the frame into the writing buffer (self._rgba) in-place,
+        while the repaint method reads the other one.
+        The QImages wrap the buffers' memory without copying them.
+        So the only copy per frame is the QPixmap conversion.
+        The conversion is in-place into the two persistent QPixmaps in turn,
+        the one not shown by the pixmap container is not shared, so its storage is reused.
+
+        The buffers are handed off by their indexes through the queues, instead of a lock.
+        The free queue holds the buffers to write,
+        and the ready queue holds at most one buffer to paint.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        self._bufs = [
+            np.zeros((self.height, self.width, 4), dtype=np.uint8) for _ in range(2)]
+        self._qimgs = [
+            QImage(buf.data, self.width, self.height, 4*self.width, QImage.Format.Format_RGBA8888) for buf in self._bufs]
+        self._free = queue.SimpleQueue()
+        self._ready = queue.Queue(maxsize=1)
+        for idx in range(len(self._bufs)):
+            self._free.put(idx)
+        self._take_buffer()
+
+        self._pixmaps = [QPixmap(self.width, self.height) for _ in range(2)]
+        for pixmap in self._pixmaps:
+            pixmap.fill(Qt.GlobalColor.transparent)
+        self._pixmap_idx = 0
+
+    def _take_buffer(self):
+        '''Take a free buffer as the writing buffer, it waits until a buffer is painted if there is none.'''
+        self._write_idx = self._free.get()
+        self._rgba = self._bufs[self._write_idx]
+
+    def _publish_buffer(self):
+        '''Publish the writing buffer to paint, the unpainted older one is dropped back to the free queue.'''
+        try:
+            self._free.put(self._ready.get_nowait())
+        except queue.Empty:
+            pass
+        self._ready.put_nowait(self._write_idx)
+
+    def _pre_render(self, period: float, shape: tuple, render):
+        """
+        Pre-render the frames of one stimulus period into the frame cache.
+
+        The stimulus repeats every period, so the frame at the time (t) is looked up from the cache
+        instead of rasterized, and the focus point is put on it afterwards.
+        The cache is opt-in by the preRender config,
+        and it falls back to render every frame when the frames can not repeat in the period,
+        or they exceed the memory budget.
+
+        Parameters:
+        period (float): The period of the stimulus in seconds.
+        shape (tuple): The (height, width, 4) shape of the cached frame.
+        render (callable): The render(frame, t) renders the frame at the time (t) without the focus point.
+
+        Returns:
+        None
+        """
+        self._frames = None
+        cpr = config.preRender
+        if not cpr.toggled:
+            return
+
+        # The flicking must finish the whole cycles in the period
+        if not float(config.checkboxTexture.flickingRate * period).is_integer():
+            logger.warning(
+                f'The flicking does not repeat in the period of {period} seconds, fall back to render every frame')
+            return
+
+        n = int(round(period * self.screen.refreshRate()))
+        nbytes = n * int(np.prod(shape))
+        if nbytes > cpr.memoryBudget * 2**20:
+            logger.warning(
+                f'The {n} frames need {nbytes / 2**20:.0f} MB, over the budget of {cpr.memoryBudget} MB, fall back to render every frame')
+            return
+
+        tic = time.perf_counter()
+        frames = np.empty((n, *shape), dtype=np.uint8)
+        for k in range(n):
+            render(frames[k], k * period / n)
+        self._frames = frames
+        self._frames_per_second = n / period
+
+        # The focus point is put on the cached frames by its small box
+        r = int(np.ceil(config.focusPoint.radius)) + 1
+        cx = int(self.width / 2)
+        cy = int(self.height / 2)
+        self._focus_box = np.s_[cy-r:cy+r+1, cx-r:cx+r+1]
+        mgy, mgx = np.mgrid[self._focus_box]
+        self._focus_disc = (mgx - self.width / 2)**2 + \
+            (mgy - self.height / 2)**2 <= config.focusPoint.radius**2
+
+        logger.info(
+            f'Pre-rendered {n} frames ({nbytes / 2**20:.0f} MB) in {time.perf_counter()-tic:.2f} seconds')
+
+    def _cached_frame(self, t: float) -> np.ndarray:
+        '''The pre-rendered frame at the time (t).'''
+        return self._frames[int(t * self._frames_per_second) % len(self._frames)]
+
+    def _put_focus_point(self):
+        '''Put the focus point on the writing buffer.'''
+        self._rgba[self._focus_box][self._focus_disc] = self.focus_color
+
     def _prepare_window(self):
         """
         Prepare the window for displaying images on screen.
 
         This function sets various attributes and configurations for the window,
-        including translucency, framelessness, topmost position, size, and geometry.
+        including translucency, framelessness, topmost position, focus policy, size, and geometry.
         It also sets the pixmap container within the window bounds.
 
         Parameters:
@@ -83,13 +250,14 @@ class OnScreenDisplay(object):
 
         # Disable frame and keep the window on the top layer.
         # It is necessary to set the FramelessWindowHint for the WA_TranslucentBackground works.
-        # The WindowTransparentForInput option disables interaction.
         self.window.setWindowFlags(
             Qt.WindowType.FramelessWindowHint |
-            Qt.WindowType.WindowStaysOnTopHint |
-            Qt.WindowType.WindowTransparentForInput
+            Qt.WindowType.WindowStaysOnTopHint
         )
 
+        # Accept the keyboard focus, so the key shortcuts are delivered
+        self.window.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
+
         # Set the window size
         self.window.resize(self.width, self.height)
 
@@ -101,21 +269,14 @@ class OnScreenDisplay(object):
         # and it is within the window bounds
         self.pixmap_container.setGeometry(0, 0, self.width, self.height)
 
-    @contextlib.contextmanager
-    def acquire_lock(self):
-        '''Lock the context'''
-        self._rlock.acquire()
-        try:
-            yield
-        finally:
-            self._rlock.release()
-
     def repaint(self):
         """
         Update the display with the current pixmap.
 
-        This function acquires a lock to ensure thread safety while updating the display.
-        It checks if a pixmap is available and sets it to the pixmap container within the window.
+        This function takes the latest ready buffer, converts it into the pixmap not on the screen,
+        and sets it to the pixmap container within the window.
+        The buffer is owned by this function during the conversion, and it is freed afterwards.
+        It does nothing if there is no new buffer since the last painting.
 
         Parameters:
         None
@@ -123,15 +284,23 @@ class OnScreenDisplay(object):
         Returns:
         None
         """
-        with self.acquire_lock():
-            if pixmap := self.pixmap:
-                self.pixmap_container.setPixmap(pixmap)
+        try:
+            idx = self._ready.get_nowait()
+        except queue.Empty:
+            return
+
+        self.pixmap = self._pixmaps[self._pixmap_idx]
+        self.pixmap.convertFromImage(self._qimgs[idx])
+        self.pixmap_container.setPixmap(self.pixmap)
+        self._pixmap_idx ^= 1
+        self._free.put(idx)
         return
 
     def main_loop(self):
         """
         Start a daemon thread to continuously generate images and update the display.
-        This function creates a new daemon thread that runs the `_main_loop` method.
+        This function creates a new daemon thread that runs the `_main_loop` method,
+        and starts the repaint timer.
 
         Parameters:
         None
@@ -144,6 +313,7 @@ class OnScreenDisplay(object):
             logger.warning('The loop is already running.')
             return
         Thread(target=self._main_loop, daemon=True).start()
+        self._repaint_timer.start()
         return
 
     def get_running_state(self):
@@ -151,6 +321,7 @@ class OnScreenDisplay(object):
 
     def stop_running(self):
         self.running = False
+        self._repaint_timer.stop()
         return
 
     def _main_loop(self):
@@ -158,7 +329,8 @@ class OnScreenDisplay(object):
         The main loop for the on-screen display.
 
         This function continuously generates images based on the current time and updates the display.
-        It measures the frame rate and prints it every 10 frames.
+        The generation is limited to the screen's refresh rate, since the faster frames are never painted.
+        It measures the frame rate and logs it every report interval.
 
         Parameters:
         None
@@ -169,36 +341,49 @@ class OnScreenDisplay(object):
         report_interval = 2  # seconds
         next_report_time = report_interval  # seconds
 
+        # The frames are scheduled on the monotonically increasing deadlines,
+        # so the sleeping errors are not accumulated.
+        frame_interval = 1 / self.screen.refreshRate()  # seconds
+        next_frame_time = time.perf_counter()
+
+        # The ring animation starts at the offset by seconds
+        start_offset = config.temporalDesign.startOffset
+
         self.running = True
-        tic = time.time()
+        tic = time.perf_counter()
         i = 0
         loop_id = f'Loop-{np.random.random():.4f}-{time.time():.8f}'
         logger.info(f'Start running: {loop_id}')
         while self.running:
             i += 1
-            t = time.time()-tic
-
-            # Generate the frame img.
-            # The ring animation starts at the offset by seconds.
-            img = self.generate_img(t-config.temporalDesign.startOffset)
-            # Put the img into pixmap
-            if self.running:
-                with self.acquire_lock():
-                    self.pixmap = QPixmap.fromImage(ImageQt(img))
-
-            # ! Sleep or not
-            # time.sleep(0.01)
+            t = time.perf_counter()-tic
+
+            # Generate the frame into the writing buffer.
+            self.generate_img(t-start_offset)
+            # Publish the buffer to paint the frame, and take the next one
+            self._publish_buffer()
+            self._take_buffer()
+
+            # Sleep until the next frame.
+            # If it is already late, restart the schedule from now.
+            next_frame_time += frame_interval
+            delay = next_frame_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame_time = time.perf_counter()
 
             # Report frame rate
             if t > next_report_time:
-                print(f'Frame rate: {i/t:0.2f}')
-                next_report_time += next_report_time
+                logger.debug(f'Frame rate: {i/t:0.2f}')
+                next_report_time += report_interval
 
         logger.debug(f'Stopped running: {loop_id}')
 
     def place_img(self, img: Image):
-        mat = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        mat[:, :, 3] = 255
+        # The opaque black background, filled by one word per pixel
+        mat = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        mat.view('<u4')[:] = 0xFF000000
         bg = Image.fromarray(mat, mode='RGBA')
 
         a1 = bg.width / bg.height
@@ -214,7 +399,12 @@ class OnScreenDisplay(object):
             bg.paste(img, (0, int((bg.height-img.height)/2)))
         logger.debug(f'Resized img: {img.size}')
 
-        self.pixmap = QPixmap.fromImage(ImageQt(bg))
+        # Put the img into the writing buffer and paint it directly,
+        # since the repaint timer is not started until the main_loop.
+        # It is painted until the first frame comes.
+        self._rgba[:] = np.asarray(bg)
+        self.pixmap = QPixmap.fromImage(self._qimgs[self._write_idx])
+        self.pixmap_container.setPixmap(self.pixmap)
 
 
 class EccentricityMapping(OnScreenDisplay):
@@ -235,6 +425,8 @@ class EccentricityMapping(OnScreenDisplay):
         self.place_prompt_img()
         self.change_focus_color()
         self.debug = debug
+        self._prepare_grids()
+        self._prepare_frames()
 
     def change_focus_color(self, t: float = 0) -> str:
         """
@@ -258,6 +450,10 @@ class EccentricityMapping(OnScreenDisplay):
         np.random.shuffle(config.focusPoint.colors)
         config.focusPoint.colors.append(c)
 
+        # The RGBA color of the focus point for the frames
+        self.focus_color = np.array(
+            (*ImageColor.getrgb(config.focusPoint.colors[0]), 255), dtype=np.uint8)
+
         logger.debug(
             f'Changed focus point color from {c} to {config.focusPoint.colors[0]}')
 
@@ -272,132 +468,211 @@ class EccentricityMapping(OnScreenDisplay):
         self.place_img(img)
         return
 
-    def generate_img(self, t: float) -> Image.Image:
+    def _prepare_grids(self):
+        """
+        Prepare the per-pixel grids for the vectorized ring generation.
+
+        The squared radius and angle of every pixel are computed only once,
+        and the checkerboard parity of the arc blocks is derived from them.
+        The squared radius is enough for binning and comparing, so there is no sqrt per pixel.
+        Only the float32 squared radius and the parity are kept for the frames,
+        it is 5 bytes per pixel, and the other grids are dropped after the init.
+        """
+        cem = config.eccentricityMapping
+        ccb = config.checkboxTexture
+
+        # The pixel coordinates relative to the center of the ring
+        mgy, mgx = np.mgrid[:self.height, :self.width]
+        mgx = mgx - self.width / 2
+        mgy = mgy - self.height / 2
+
+        # The squared radius and the angle of the pixels.
+        # The angle is in degrees and clockwise, the same as the draw.arc uses.
+        r2 = mgx*mgx + mgy*mgy
+        angle = np.rad2deg(np.arctan2(mgy, mgx)) % 360
+
+        # The arc block size.
+        # Think it as the earth, the arc blocks are segmented by the longitude and latitude.
+        arc_length = 360 / ccb.numInLongitude
+        arc_width = (cem.maxRadius - cem.minRadius) / ccb.numInLatitude
+
+        # The arc block index parity in the latitude (mr) and longitude (ma).
+        # The parity is True for the (v) colored blocks, and False for the (u) colored blocks.
+        # The latitude index is found in the squared edges of the blocks till the screen corner,
+        # the pixels inside the minRadius share the index of -1.
+        edges = np.arange(
+            cem.minRadius, np.hypot(self.width, self.height) / 2 + arc_width, arc_width)
+        mr = ((np.searchsorted(edges**2, r2, side='right') + 1) % 2).astype(np.int8)
+        ma = (angle // arc_length % 2).astype(np.int8)
+        self.parity = ((mr + ma) % 2).astype(bool)
+
+        # The float32 squared radius is exact for the integer pixel offsets of the screens
+        self.r2 = r2.astype(np.float32)
+
+        # The frame uniforms that never change
+        self.background = np.array(cem.background, dtype=np.uint8)
+        self.debug_color = np.array(
+            (*ImageColor.getrgb(config.colors.debugColor), 255), dtype=np.uint8)
+        self._no_curves = np.empty((0, 2), dtype=np.float64)
+
+        # The configuration constants used by the frames,
+        # they are read once instead of looking up the config every frame.
+        self._min_radius = cem.minRadius
+        self._radius_span = cem.maxRadius - cem.minRadius
+        self._half_width = cem.width / 2
+        self._duration = cem.duration
+        self._focus_toggled = config.focusPoint.toggled
+        self._focus_radius = config.focusPoint.radius
+
+        # The radius of the dirty box in each buffer.
+        # The buffers are dirty as a whole at first,
+        # and only the box bounding the ring is rewritten since then.
+        self._dirty_radii = [np.hypot(self.width, self.height)] * 2
+
+        # Compile or load the kernel before the frames, on scratch boxes with the same types,
+        # so the render thread does not pay for it after the main_loop starts.
+        # The whole screen box is contiguous and the ring boxes are not, they are typed differently.
+        scratch = np.empty_like(self._rgba)
+        for r in (np.hypot(self.width, self.height), 1):
+            box = self._bounding_box(r)
+            fill_ring(scratch[box], self.r2[box], self.parity[box], 0.0, 0.0,
+                      0, 0, self.background,
+                      self._no_curves, self.debug_color, -1.0, self.background)
+        return
+
+    def _prepare_frames(self):
+        """
+        Pre-render the ring frames of one duration.
+
+        The cached frames cover the box bounding the largest ring and the focus point.
+        """
+        self._frames_radius = max(
+            self._min_radius + self._radius_span + self._half_width, self._focus_radius)
+        self._frames_box = self._bounding_box(self._frames_radius)
+        box = self._frames_box
+
+        def render(frame, t):
+            r_min, r_max, v, u, curves = self._ring_uniforms(t)
+            fill_ring(frame, self.r2[box], self.parity[box], r_min*abs(r_min), r_max*r_max,
+                      v, u, self.background,
+                      curves, self.debug_color, -1.0, self.background)
+
+        self._pre_render(self._duration, self.r2[box].shape + (4, ), render)
+        return
+
+    def _ring_uniforms(self, t: float) -> tuple:
+        """
+        The uniforms of the ring at the time (t).
+
+        Parameters:
+        t (float): The current time in seconds.
+
+        Returns:
+        tuple: The inner and outer boundaries, the color values (v, u) and the squared boundaries of the debug curves.
+        """
+        # The r_center is the center of the ring.
+        # The r_min, r_max is the inner and outer boundaries.
+        r_center = self._min_radius + \
+            ((t % self._duration) / self._duration) * self._radius_span
+        r_max = r_center + self._half_width
+        r_min = r_center - self._half_width
+
+        # The current color value (v) of sin functional,
+        # and u is its reverse
+        v, u = self.flicking_colors(t)
+
+        # The debug curves are 2 pixels width inside the r
+        curves = self._no_curves
+        if self.debug:
+            curves = np.array([((r-2)*abs(r-2), r*r)
+                               for r in (r_center, r_min, r_max) if r > 0], dtype=np.float64)
+
+        return r_min, r_max, v, u, curves
+
+    def _bounding_box(self, r: float) -> tuple:
+        """
+        The box bounding the circle of radius (r) on the center, clipped by the screen.
+
+        Parameters:
+        r (float): The radius of the circle.
+
+        Returns:
+        tuple: The slices of the box, it is used to index the (height, width) grids.
+        """
+        cx = self.width / 2
+        cy = self.height / 2
+        x0 = max(int(np.floor(cx-r)), 0)
+        x1 = min(int(np.ceil(cx+r))+1, self.width)
+        y0 = max(int(np.floor(cy-r)), 0)
+        y1 = min(int(np.ceil(cy+r))+1, self.height)
+        return np.s_[y0:y1, x0:x1]
+
+    def generate_img(self, t: float) -> np.ndarray:
         """
         Generate an image for the eccentricity mapping display.
 
         This function generates an image based on the current time (t) and the configuration settings.
-        The image is created using the PIL library and represents a ring with alternating colors.
+        The image represents a ring with alternating colors, it is filled into the persistent RGBA buffer
+        by the per-pixel radius and parity grids.
+        Only the box bounding the rings of the buffer's last frame and the current frame is rewritten,
+        the other pixels keep the background.
+        The frame is copied from the pre-rendered frames instead if they are cached.
         The ring's size, color, and position are determined by the configuration settings.
 
         Parameters:
         t (float): The current time in seconds.
 
         Returns:
-        Image.Image: The generated image for the eccentricity mapping display.
+        np.ndarray: The RGBA buffer of the generated image.
         """
-        # Get the configuration object
-        cem = config.eccentricityMapping
-        ccb = config.checkboxTexture
-
-        # Generate the image and its drawing context.
-        # The initializing color is (0, 0, 0, 0) for all the pixels
-        mat = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        mat[:, :] = cem.background
-        img = Image.fromarray(mat.astype(np.uint8), mode='RGBA')
-        draw = ImageDraw.Draw(img)
-
-        def draw_ring():
-            '''Draw the ring at the time (t).'''
-            # The r_center is the center of the ring.
-            # The r_min, r_max is the inner and outer boundaries.
-            r_center = cem.minRadius + ((t % cem.duration) / cem.duration) * \
-                (cem.maxRadius - cem.minRadius)
-            r_max = r_center + cem.width/2
-            r_min = r_center - cem.width/2
-
-            # The current color value (v) of sin functional,
-            # and u is its reverse
-            sin = np.sin(ccb.flickingRate*t*np.pi*2)
-            v = np.uint8((np.abs(np.power(sin, 1))*np.sign(sin)+1)*0.5*255)
-            u = np.uint8(255-v)
-
-            # Center of the ring
-            cx = self.width / 2
-            cy = self.height / 2
-
-            # The arc block size.
-            # Think it as the earth, the arc blocks are segmented by the longitude and latitude.
-            arc_length = 360 / ccb.numInLongitude
-            arc_width = (cem.maxRadius - cem.minRadius) / ccb.numInLatitude
-
-            # The draw.arc box means the ring NEVER exceed the box,
-            # or, the arc_width grows inside.
-            # The r refers the bounding box size of the "narrow" arc block.
-            # The angle refers the start angle of the arc block.
-            for j, r in enumerate(np.linspace(cem.minRadius, cem.maxRadius+arc_width*2, 2+ccb.numInLatitude, endpoint=False)):
-                # Not draw if the r is small and outside the ring range.
-                if r < r_min:
-                    continue
-
-                # Not draw if the r is large and outside the ring range.
-                if r-arc_width > r_max:
-                    continue
-
-                # Initialize as the NORMAL condition
-                w = arc_width
-                box = (cx-r, cy-r, cx+r, cy+r)
-
-                # Shrink the width in the most inner blocks
-                if r - arc_width < r_min:
-                    w = r - r_min
-                # Shrink the width and shrink the box in the most outer blocks.
-                # Restrict the s + w = arc_width to prevent blinking the edge.
-                elif r > r_max and r-arc_width < r_max:
-                    w = int(arc_width-(r-r_max))
-                    s = arc_width - w
-                    box = (cx-r+s, cy-r+s, cx+r-s, cy+r-s)
-
-                # Safely convert the width (w)
-                w = int(w)
-
-                # Draw the arc blocks one-by-one with DIFFERENT colors
-                for i, angle in enumerate(np.linspace(0, 360, ccb.numInLongitude, endpoint=False)):
-                    if i % 2 == j % 2:
-                        fill = (v, v, v, 255)
-                    else:
-                        fill = (u, u, u, 255)
-                    draw.arc(
-                        box, start=angle, end=angle+arc_length, width=w, fill=fill)
-
-            # Draw the debug curves.
-            if self.debug:
-                color = config.colors.debugColor
-                box = (cx-r_center, cy-r_center, cx+r_center, cy+r_center)
-                draw.arc(
-                    box, start=0, end=360, width=2, fill=color)
-
-                if r_min > 0:
-                    box = (cx-r_min, cy-r_min, cx+r_min, cy+r_min)
-                    draw.arc(
-                        box, start=0, end=360, width=2, fill=color)
-
-                box = (cx-r_max, cy-r_max, cx+r_max, cy+r_max)
-                draw.arc(
-                    box, start=0, end=360, width=2, fill=color)
-                return
+        # The writing buffer, it keeps the frame before the previous one
+        idx = self._write_idx
+        mat = self._rgba
 
         if t > 0:
             # Report if the new circles is started.
-            circles = int(np.ceil(t / cem.duration))
+            circles = int(np.ceil(t / self._duration))
             if circles > self.circles:
                 self.circles = circles
                 logger.info(f'Circles changed to {self.circles}')
-            # Draw the ring.
-            draw_ring()
 
-        # Put the focus point on the center
-        if config.focusPoint.toggled:
-            if t > self.t_next_change_focus_color:
-                self.change_focus_color(t)
+        if self._focus_toggled and t > self.t_next_change_focus_color:
+            self.change_focus_color(t)
+
+        # Copy the pre-rendered frame,
+        # the previous frame outside its box is cleared with the background color.
+        if t > 0 and self._frames is not None:
+            if self._dirty_radii[idx] > self._frames_radius:
+                mat[self._bounding_box(self._dirty_radii[idx])] = self.background
+            self._dirty_radii[idx] = self._frames_radius
+            mat[self._frames_box] = self._cached_frame(t)
+            if self._focus_toggled:
+                self._put_focus_point()
+            return mat
+
+        # The ring is empty before the start
+        if t > 0:
+            r_min, r_max, v, u, curves = self._ring_uniforms(t)
+        else:
+            r_min, r_max, v, u, curves = 0.0, 0.0, 0, 0, self._no_curves
+
+        # The focus point on the center, it is not drawn with the negative radius
+        r_focus = self._focus_radius if self._focus_toggled else -1
 
-            radius = config.focusPoint.radius
-            color = config.focusPoint.colors[0]
-            box = (
-                self.width//2-radius, self.height//2-radius, self.width//2+radius, self.height//2+radius)
-            draw.ellipse(box, fill=color)
+        # The dirty box bounds both the previous and current frames,
+        # so the previous ring is cleared when the current frame is drawn.
+        r = max(r_max, r_focus)
+        box = self._bounding_box(max(self._dirty_radii[idx], r))
+        self._dirty_radii[idx] = max(r, 0)
 
-        return img
+        # Render the ring, the debug curves and the focus point in a single pass.
+        # The boundaries are compared by their signed squares,
+        # so the negative r_min keeps all the inner pixels.
+        fill_ring(mat[box], self.r2[box], self.parity[box], r_min*abs(r_min), r_max*r_max,
+                  v, u, self.background,
+                  curves, self.debug_color, float(r_focus*abs(r_focus)), self.focus_color)
+
+        return mat
 
 
 class PolarAngleMapping(OnScreenDisplay):
@@ -408,6 +683,8 @@ class PolarAngleMapping(OnScreenDisplay):
         self.place_prompt_img()
         self.change_focus_color()
         self.debug = debug
+        self._prepare_grids()
+        self._prepare_frames()
 
     def change_focus_color(self, t: float = 0) -> str:
         """
@@ -431,6 +708,10 @@ class PolarAngleMapping(OnScreenDisplay):
         np.random.shuffle(config.focusPoint.colors)
         config.focusPoint.colors.append(c)
 
+        # The RGBA color of the focus point for the frames
+        self.focus_color = np.array(
+            (*ImageColor.getrgb(config.focusPoint.colors[0]), 255), dtype=np.uint8)
+
         logger.debug(
             f'Changed focus point color from {c} to {config.focusPoint.colors[0]}')
 
@@ -445,113 +726,178 @@ class PolarAngleMapping(OnScreenDisplay):
         self.place_img(img)
         return
 
-    def generate_img(self, t: float) -> Image.Image:
-        # Get the configuration object
+    def _prepare_grids(self):
+        """
+        Prepare the per-pixel grids for the vectorized polar generation.
+
+        The grids only cover the box bounding the polar and the focus point,
+        the other pixels keep the background.
+        The angle and the arc block indexes of every pixel are computed only once,
+        and every frame only selects the pixels inside the spin.
+        """
         cpam = config.polarAngleMapping
         ccb = config.checkboxTexture
 
-        # Generate the image and its drawing context.
-        # The initializing color is (0, 0, 0, 0) for all the pixels
-        mat = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        mat[:, :] = cpam.background
-        img = Image.fromarray(mat.astype(np.uint8), mode='RGBA')
-        draw = ImageDraw.Draw(img)
-
-        def draw_polar():
-            '''Draw the polar at the time (t).'''
-            # The a_center is the center of the spin.
-            # The a_min, a_max are the front and back boundaries.
-            a_center = ((t % cpam.duration)/cpam.duration) * 360
-            a_min = a_center - cpam.width/2
-            a_max = a_center + cpam.width/2
-
-            # The current color value (v) of sin functional,
-            # and u is its reverse
-            sin = np.sin(ccb.flickingRate*t*np.pi*2)
-            v = np.uint8((np.abs(np.power(sin, 1))*np.sign(sin)+1)*0.5*255)
-            u = np.uint8(255-v)
-
-            # Center of the ring
-            cx = self.width / 2
-            cy = self.height / 2
-
-            # The arc block size
-            # Think it as the earth, the arc blocks are segmented by the longitude and latitude.
-            arc_length = 360 / ccb.numInLongitude
-            arc_width = (cpam.maxRadius - cpam.minRadius) / ccb.numInLatitude
-            # Find the nearest back edge with the a_min,
-            # in case it is negative value,
-            # or the a_max exceeds 360 degrees.
-            offset = a_min // arc_length
-
-            # The draw.arc box means the ring NEVER exceed the box,
-            # or, the arc_width grows inside.
-            # The r refers the bounding box size of the "narrow" arc block.
-            # The angle refers the start angle of the arc block.
-            for j, r in enumerate(np.linspace(cpam.minRadius, cpam.maxRadius, ccb.numInLatitude, endpoint=False)):
-                w = int(arc_width)
-                box = (cx-r, cy-r, cx+r, cy+r)
-
-                # Draw the arc blocks one-by-one with DIFFERENT colors
-                for angle in np.linspace(0, 360, ccb.numInLongitude, endpoint=False):
-                    angle += offset * arc_length
-                    i = angle // arc_length
-
-                    # Not draw if angle exceeds a_max
-                    if angle > a_max:
-                        continue
-
-                    # Not draw if angle belows a_min
-                    if angle+arc_length < a_min:
-                        continue
-
-                    # Setup start and end angles with arc blocks INSIDE spin
-                    start = angle
-                    end = angle + arc_length
-
-                    # Shrink end if front edge exceeds
-                    if angle + arc_length > a_max:
-                        end = a_max
-
-                    # Increase start if tail edge exceeds
-                    if angle < a_min:
-                        start = a_min
-
-                    if i % 2 == j % 2:
-                        fill = (v, v, v, 255)
-                    else:
-                        fill = (u, u, u, 255)
-                    draw.arc(
-                        box, start=start, end=end, width=w, fill=fill)
-
-                # Draw the debug curves
-                if self.debug:
-                    draw.arc(
-                        box, start=a_min, end=a_max, width=2, fill=config.colors.debugColor)
+        # The box bounding the polar and the focus point
+        r = max(cpam.maxRadius, config.focusPoint.radius) + 1
+        cx = self.width // 2
+        cy = self.height // 2
+        self.box = np.s_[max(cy-r, 0):min(cy+r+1, self.height),
+                         max(cx-r, 0):min(cx+r+1, self.width)]
+
+        # The pixel coordinates relative to the center of the polar
+        mgy, mgx = np.mgrid[self.box]
+        mgx = mgx - self.width / 2
+        mgy = mgy - self.height / 2
+
+        # The squared radius and the angle of the pixels.
+        # The angle is in degrees and clockwise, the same as the draw.arc uses.
+        r2 = mgx*mgx + mgy*mgy
+        self.angle = (np.rad2deg(np.arctan2(mgy, mgx)) % 360).astype(np.float32)
+
+        # The arc block size
+        # Think it as the earth, the arc blocks are segmented by the longitude and latitude.
+        arc_length = 360 / ccb.numInLongitude
+        arc_width = (cpam.maxRadius - cpam.minRadius) / ccb.numInLatitude
+
+        # The arc block (j) of the draw.arc version is bounded by the radius of r and grows inside,
+        # r = minRadius + j * arc_width, j = 0, 1, ..., numInLatitude-1.
+        # The block index is found in the signed squared edges of the blocks.
+        edges = cpam.minRadius + \
+            arc_width * np.arange(-1, ccb.numInLatitude)
+        # The pixels inside the annulus are 0 <= rho < numInLatitude.
+        # The blocks with the same parities of rho and theta are the (v) colored blocks.
+        self.rho = (np.searchsorted(
+            edges*np.abs(edges), r2, side='left') - 1).astype(np.int16)
+        self.theta = (self.angle // arc_length).astype(np.int16)
+
+        # The debug curves are 2 pixels width inside the bounding radius of the arc blocks
+        radii = edges[1:]
+        self.curves = np.zeros(self.angle.shape, dtype=bool)
+        for r in radii:
+            self.curves |= (r2 <= r*r) & (r2 > (r-2)*abs(r-2))
+
+        # The focus point is a small disc on the center
+        self.focus_mask = r2 <= config.focusPoint.radius**2
+
+        # The frame uniforms that never change
+        self.background = np.array(cpam.background, dtype=np.uint8)
+        self.debug_color = np.array(
+            (*ImageColor.getrgb(config.colors.debugColor), 255), dtype=np.uint8)
+
+        # The configuration constants used by the frames,
+        # they are read once instead of looking up the config every frame.
+        self._spin_width = float(cpam.width)
+        self._duration = cpam.duration
+        self._focus_toggled = bool(config.focusPoint.toggled)
+
+        self._num_in_latitude = ccb.numInLatitude
+
+        # The buffers are filled with the background when they are firstly written
+        self._filled = [False] * 2
+
+        # Compile or load the kernel before the frames, on a scratch box with the same types,
+        # so the render thread does not pay for it after the main_loop starts.
+        scratch = np.empty_like(self._rgba)[self.box]
+        fill_polar(scratch, self.angle, self.theta, self.rho, self._num_in_latitude,
+                   0.0, -1.0, 0, 0, self.background,
+                   self.curves, bool(self.debug), self.debug_color,
+                   self.focus_mask, self._focus_toggled, self.background)
+        return
 
-            return
+    def _prepare_frames(self):
+        """
+        Pre-render the polar frames of one duration, the cached frames cover the box of the grids.
+        """
+        def render(frame, t):
+            a_min, a_width, v, u = self._spin_uniforms(t)
+            fill_polar(frame, self.angle, self.theta, self.rho, self._num_in_latitude,
+                       a_min, a_width, v, u, self.background,
+                       self.curves, bool(self.debug), self.debug_color,
+                       self.focus_mask, False, self.background)
+
+        self._pre_render(self._duration, self.angle.shape + (4, ), render)
+        return
+
+    def _spin_uniforms(self, t: float) -> tuple:
+        """
+        The uniforms of the spin at the time (t).
+
+        Parameters:
+        t (float): The current time in seconds.
+
+        Returns:
+        tuple: The back boundary and width of the spin in degrees, and the color values (v, u).
+        """
+        # The a_center is the center of the spin.
+        # The a_min, a_max are the front and back boundaries.
+        a_center = ((t % self._duration)/self._duration) * 360
+        a_min = a_center - self._spin_width/2
+
+        # The current color value (v) of sin functional,
+        # and u is its reverse
+        v, u = self.flicking_colors(t)
+
+        return a_min, self._spin_width, v, u
+
+    def generate_img(self, t: float) -> np.ndarray:
+        """
+        Generate an image for the polar angle mapping display.
+
+        This function generates an image based on the current time (t) and the configuration settings.
+        The image represents a spinning wedge of the annulus with alternating colors,
+        it is filled into the persistent RGBA buffer by the per-pixel angle and parity grids.
+        Only the box bounding the polar is rewritten, the other pixels keep the background.
+        The box is copied from the pre-rendered frames instead if they are cached.
+
+        Parameters:
+        t (float): The current time in seconds.
+
+        Returns:
+        np.ndarray: The RGBA buffer of the generated image.
+        """
+        # Fill the buffer with the background when it is firstly written.
+        idx = self._write_idx
+        if not self._filled[idx]:
+            self._rgba[:] = self.background
+            self._filled[idx] = True
+        mat = self._rgba[self.box]
 
         if t > 0:
             # Report if the new circles is started.
-            circles = int(np.ceil(t / cpam.duration))
+            circles = int(np.ceil(t / self._duration))
             if circles > self.circles:
                 self.circles = circles
                 logger.info(f'Circles changed to {self.circles}')
-            # Draw the polar.
-            draw_polar()
 
-        # Put the focus point on the center
-        if config.focusPoint.toggled:
-            if t > self.t_next_change_focus_color:
-                self.change_focus_color(t)
+        # The focus point on the center
+        if self._focus_toggled and t > self.t_next_change_focus_color:
+            self.change_focus_color(t)
 
-            radius = config.focusPoint.radius
-            color = config.focusPoint.colors[0]
-            box = (
-                self.width//2-radius, self.height//2-radius, self.width//2+radius, self.height//2+radius)
-            draw.ellipse(box, fill=color)
+        # Copy the pre-rendered frame
+        if t > 0 and self._frames is not None:
+            mat[:] = self._cached_frame(t)
+            if self._focus_toggled:
+                self._put_focus_point()
+            return self._rgba
 
-        return img
+        # The spin is empty before the start
+        if t > 0:
+            a_min, a_width, v, u = self._spin_uniforms(t)
+        else:
+            a_min, a_width, v, u = 0.0, -1.0, 0, 0
+
+        # Render the spin, the debug curves and the focus point in a single pass.
+        # The spin is the annulus pixels whose angle from the a_min is within the width,
+        # the angle is wrapped in case the a_min is negative, or the a_max exceeds 360 degrees.
+        # The arc blocks are filled with DIFFERENT colors by their parity,
+        # and the other pixels in the box with the background color.
+        fill_polar(mat, self.angle, self.theta, self.rho, self._num_in_latitude,
+                   a_min, a_width, v, u, self.background,
+                   self.curves, bool(self.debug), self.debug_color,
+                   self.focus_mask, self._focus_toggled, self.focus_color)
+
+        return self._rgba
 
 # %% ---- 2024-10-28 ------------------------
 # Play ground
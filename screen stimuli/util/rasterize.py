@@ -0,0 +1,165 @@
+"""
+File: rasterize.py
+Author: Chuncheng Zhang
+Date: 2026-10-15
+Copyright & Email: chuncheng.zhang@ia.ac.cn
+
+Purpose:
+    Numba kernels for rasterizing the mapping stimuli into the RGBA buffer.
+
+Functions:
+    1. Requirements and constants
+    2. Function and class
+    3. Play ground
+    4. Pending
+    5. Pending
+"""
+
+
+# %% ---- 2026-10-15 ------------------------
+# Requirements and constants
+import numpy as np
+
+from numba import njit, prange
+
+
+# %% ---- 2026-10-15 ------------------------
+# Function and class
+@njit(inline='always')
+def _put_color(mat: np.ndarray, i: int, j: int, color: np.ndarray):
+    """
+    Put the RGBA color on the pixel (i, j).
+    """
+    mat[i, j, 0] = color[0]
+    mat[i, j, 1] = color[1]
+    mat[i, j, 2] = color[2]
+    mat[i, j, 3] = color[3]
+
+
+@njit(inline='always')
+def _put_gray(mat: np.ndarray, i: int, j: int, c: int):
+    """
+    Put the opaque gray value (c) on the pixel (i, j).
+    """
+    mat[i, j, 0] = c
+    mat[i, j, 1] = c
+    mat[i, j, 2] = c
+    mat[i, j, 3] = 255
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def fill_ring(mat: np.ndarray, r2: np.ndarray, parity: np.ndarray, r2_min: float, r2_max: float, v: int, u: int, background: np.ndarray,
+              curves: np.ndarray, debug_color: np.ndarray, r2_focus: float, focus_color: np.ndarray):
+    """
+    Render the eccentricity frame into the RGBA buffer in a single pass.
+
+    It works like a fragment shader, every pixel is colored only by its own grid values and the frame uniforms.
+    The focus point covers the debug curves, the debug curves cover the ring,
+    and the other pixels are colored by the background.
+    The ring is compared by the squared radius.
+    The pixels between the r2_min and r2_max are colored by v or u according to their parity.
+    The rows are filled in parallel, and the GIL is released during the filling.
+
+    Args:
+        mat, ndarray: The (height, width, 4) uint8 RGBA buffer to fill.
+        r2, ndarray: The (height, width) squared radius of the pixels.
+        parity, ndarray: The (height, width) boolean parity of the arc blocks.
+        r2_min, float: The squared inner boundary of the ring, it is negative for the negative boundary.
+        r2_max, float: The squared outer boundary of the ring, the ring is empty if it is not positive.
+        v, int: The color value of the blocks with True parity.
+        u, int: The color value of the blocks with False parity.
+        background, ndarray: The (4, ) uint8 RGBA background color.
+        curves, ndarray: The (n, 2) squared (inner, outer] boundaries of the debug curves, n is 0 for no curves.
+        debug_color, ndarray: The (4, ) uint8 RGBA color of the debug curves.
+        r2_focus, float: The squared radius of the focus point, it is negative for no focus point.
+        focus_color, ndarray: The (4, ) uint8 RGBA color of the focus point.
+    """
+    height, width = r2.shape
+    n = curves.shape[0]
+    for i in prange(height):
+        for j in range(width):
+            d = r2[i, j]
+
+            if d <= r2_focus:
+                _put_color(mat, i, j, focus_color)
+                continue
+
+            on_curve = False
+            for k in range(n):
+                if curves[k, 0] < d <= curves[k, 1]:
+                    on_curve = True
+                    break
+            if on_curve:
+                _put_color(mat, i, j, debug_color)
+                continue
+
+            if d <= r2_min or d >= r2_max:
+                _put_color(mat, i, j, background)
+                continue
+
+            _put_gray(mat, i, j, v if parity[i, j] else u)
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def fill_polar(mat: np.ndarray, angle: np.ndarray, theta: np.ndarray, rho: np.ndarray, num_in_latitude: int, a_min: float, a_width: float, v: int, u: int, background: np.ndarray,
+               curves: np.ndarray, debug: bool, debug_color: np.ndarray, focus: np.ndarray, toggled: bool, focus_color: np.ndarray):
+    """
+    Render the polar angle frame into the RGBA buffer in a single pass.
+
+    It works like a fragment shader, every pixel is colored only by its own grid values and the frame uniforms.
+    The focus point covers the debug curves, the debug curves cover the spinning wedge,
+    and the other pixels are colored by the background.
+    The pixels inside the annulus and within the a_width from the a_min are colored by v or u
+    according to the parity of their arc block indexes.
+    The rows are filled in parallel, and the GIL is released during the filling.
+
+    Args:
+        mat, ndarray: The (height, width, 4) uint8 RGBA buffer to fill.
+        angle, ndarray: The (height, width) angle of the pixels in degrees.
+        theta, ndarray: The (height, width) arc block index in the longitude.
+        rho, ndarray: The (height, width) arc block index in the latitude, it is outside the annulus if not in [0, num_in_latitude).
+        num_in_latitude, int: The number of the arc blocks in the latitude.
+        a_min, float: The back boundary of the spin in degrees.
+        a_width, float: The width of the spin in degrees, the spin is empty if it is negative.
+        v, int: The color value of the blocks with the same index parities.
+        u, int: The color value of the other blocks.
+        background, ndarray: The (4, ) uint8 RGBA background color.
+        curves, ndarray: The (height, width) boolean mask of the debug curves.
+        debug, bool: Whether to draw the debug curves inside the spin.
+        debug_color, ndarray: The (4, ) uint8 RGBA color of the debug curves.
+        focus, ndarray: The (height, width) boolean mask of the focus point.
+        toggled, bool: Whether to draw the focus point.
+        focus_color, ndarray: The (4, ) uint8 RGBA color of the focus point.
+    """
+    height, width = angle.shape
+    for i in prange(height):
+        for j in range(width):
+            if toggled and focus[i, j]:
+                _put_color(mat, i, j, focus_color)
+                continue
+
+            in_spin = (angle[i, j] - a_min) % 360 <= a_width
+
+            if debug and in_spin and curves[i, j]:
+                _put_color(mat, i, j, debug_color)
+                continue
+
+            # The unsigned comparison checks both 0 <= k and k < num_in_latitude
+            k = rho[i, j]
+            if np.uint16(k) >= num_in_latitude or not in_spin:
+                _put_color(mat, i, j, background)
+                continue
+
+            _put_gray(mat, i, j, v if (theta[i, j] + k) % 2 == 0 else u)
+
+
+# %% ---- 2026-10-15 ------------------------
+# Play ground
+
+
+# %% ---- 2026-10-15 ------------------------
+# Pending
+
+
+# %% ---- 2026-10-15 ------------------------
+# Pending
@@ -22,7 +22,7 @@ import sys
 import argparse
 import pandas as pd
 
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt
 from util.display import SequenceStimuli
 from util import logger, CONFIG
 
@@ -55,8 +55,12 @@ if __name__ == "__main__":
     if not namespace.wait:
         stimuli.main_loop()
 
-    def _on_timeout():
-        stimuli.repaint()
+    # The key handlers by their key codes, the key names are resolved only once.
+    # The quit key quits the app,
+    # and the start key starts the main loop if waiting for it.
+    _KEY_HANDLERS = {Qt.Key[CONFIG.control.quitKeyName].value: stimuli.app.quit}
+    if namespace.wait:
+        _KEY_HANDLERS[Qt.Key[CONFIG.control.startKeyName].value] = stimuli.main_loop
 
     def _on_key_pressed(event):
         '''
@@ -65,22 +69,10 @@ if __name__ == "__main__":
         Args:
             - event: The pressed event.
         '''
-
-        try:
-            key = event.key()
-            enum = Qt.Key(key)
-            logger.debug(f'Key pressed: {key}, {enum.name}')
-
-            # The quite key is pressed, quit the app
-            if enum.name == CONFIG.control.quitKeyName:
-                stimuli.app.quit()
-
-            # The start key is pressed, start the main loop
-            if namespace.wait and enum.name == CONFIG.control.startKeyName:
-                stimuli.main_loop()
-
-        except Exception as err:
-            logger.error(f'Key pressed but I got an error: {err}')
+        if handler := _KEY_HANDLERS.get(event.key()):
+            handler()
+        else:
+            logger.debug(f'Key pressed: {event.key()}')
 
     def _about_to_quit():
         '''
@@ -94,12 +86,8 @@ if __name__ == "__main__":
     stimuli.app.aboutToQuit.connect(_about_to_quit)
     stimuli.window.keyPressEvent = _on_key_pressed
 
-    # Bind to the timer and run
-    timer = QTimer()
-    timer.timeout.connect(_on_timeout)
-    timer.start()
-
-    # Proper exit
+    # Proper exit.
+    # The stimuli generates the frames by its own timer since the main loop starts.
     sys.exit(stimuli.app.exec())
 
 # %% ---- 2024-11-01 ------------------------
@@ -21,24 +21,22 @@ Functions:
 import pandas as pd
 import os
 import sys
-import time
-import contextlib
+import uuid
 
 import numpy as np
 
-from PIL import Image, ImageDraw
-from PIL.ImageQt import ImageQt
+from PIL import Image, ImageColor
 
-from PyQt6.QtGui import QPixmap
-from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QPixmap, QImage
+from PyQt6.QtCore import Qt, QObject, QTimer, QElapsedTimer, pyqtSignal
 from PyQt6.QtWidgets import QMainWindow, QApplication, QLabel
 
-from rich import print
 from pathlib import Path
-from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
 
 from . import logger, CONFIG, current_dir
 from .mk_sequence_from_dataframe_nsd import mk_sequence_from_dataframe_nsd
+from .rasterize import blend_into
 
 # %% ---- 2024-11-01 ------------------------
 # Function and class
@@ -49,7 +47,7 @@ screen = app.screens()[CONFIG.display.screenId]
 logger.debug(f'Screen: {CONFIG.display.screenId}: {screen}, {screen.size()}')
 
 
-class OnScreenDisplay(object):
+class OnScreenDisplay(QObject):
     app = app
     screen = screen
 
@@ -62,12 +60,37 @@ class OnScreenDisplay(object):
 
     running = False
 
-    _rlock = RLock()
+    # The frame is handed to the pixmap container by the signal
+    frameReady = pyqtSignal(QPixmap)
 
     def __init__(self):
+        super().__init__()
         self._prepare_window()
+        self._prepare_timer()
         logger.info(f'Initialized {self}')
 
+    def _prepare_timer(self):
+        """
+        Prepare the timer generating the frames at the screen's refresh rate.
+
+        The frames are generated on the GUI thread by the timer,
+        and they are handed to the pixmap container by the frameReady signal,
+        so there is no lock between the threads.
+        The time is measured by the monotonic elapsed timer.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        self._frame_timer = QTimer(self.window)
+        self._frame_timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._frame_timer.setInterval(int(1000 / self.screen.refreshRate()))
+        self._frame_timer.timeout.connect(self._main_loop)
+        self._elapsed_timer = QElapsedTimer()
+        self.frameReady.connect(self._set_pixmap)
+
     def _prepare_window(self):
         """
         Prepare the window for displaying images on screen.
@@ -105,37 +128,23 @@ class OnScreenDisplay(object):
         # and it is within the window bounds
         self.pixmap_container.setGeometry(0, 0, self.width, self.height)
 
-    @contextlib.contextmanager
-    def acquire_lock(self):
-        '''Lock the context'''
-        self._rlock.acquire()
-        try:
-            yield
-        finally:
-            self._rlock.release()
-
-    def repaint(self):
+    def _set_pixmap(self, pixmap: QPixmap):
         """
-        Update the display with the current pixmap.
-
-        This function acquires a lock to ensure thread safety while updating the display.
-        It checks if a pixmap is available and sets it to the pixmap container within the window.
+        Update the display with the pixmap, it is the slot of the frameReady signal.
 
         Parameters:
-        None
+        pixmap (QPixmap): The pixmap of the frame.
 
         Returns:
         None
         """
-        with self.acquire_lock():
-            if pixmap := self.pixmap:
-                self.pixmap_container.setPixmap(pixmap)
-        return
+        self.pixmap = pixmap
+        self.pixmap_container.setPixmap(pixmap)
 
     def main_loop(self):
         """
-        Start a daemon thread to continuously generate images and update the display.
-        This function creates a new daemon thread that runs the `_main_loop` method.
+        Start the frame timer to continuously generate images and update the display.
+        The timer runs the `_main_loop` method for every frame.
 
         Parameters:
         None
@@ -143,21 +152,53 @@ class OnScreenDisplay(object):
         Returns:
         None
         """
-        Thread(target=self._main_loop, daemon=True).start()
+        self._report_interval = 2  # seconds
+        self._next_report_time = self._report_interval  # seconds
+        self._frame_count = 0
+        self._start_offset = CONFIG.temporalDesign.startOffset
+
+        # The frame count and time of the last report, the time starts from the negative offset
+        self._report_count = 0
+        self._report_t = -self._start_offset
+
+        # The key of the last generated frame
+        self._last_frame_key = None
+
+        self.running = True
+        self._elapsed_timer.start()
+        self._loop_id = f'Loop-{uuid.uuid4().hex[:8]}'
+        logger.info(f'Start running: {self._loop_id}')
+        self._frame_timer.start()
 
     def get_running_state(self):
         return self.running
 
     def stop_running(self):
+        if self.running:
+            logger.debug(f'Stopped running: {self._loop_id}')
         self.running = False
+        self._frame_timer.stop()
         return
 
+    def frame_key(self, t: float):
+        """
+        The key of the frame at the time (t), the frame is not generated if its key is the same as the last one.
+
+        Parameters:
+        t (float): The current time in seconds.
+
+        Returns:
+        The hashable key of the frame, or None to always generate the frame.
+        """
+        return None
+
     def _main_loop(self):
         """
-        The main loop for the on-screen display.
+        The frame of the main loop for the on-screen display.
 
-        This function continuously generates images based on the current time and updates the display.
-        It measures the frame rate and prints it every 10 frames.
+        This function generates the image based on the current time and updates the display.
+        The frame is skipped if it is unchanged, so the display is not updated either.
+        It measures the frame rate since the last report and logs it every report interval.
 
         Parameters:
         None
@@ -165,41 +206,35 @@ class OnScreenDisplay(object):
         Returns:
         None
         """
-        report_interval = 2  # seconds
-        next_report_time = report_interval  # seconds
-
-        self.running = True
-        tic = time.time()
-        i = 0
-        loop_id = f'Loop-{np.random.random():.4f}-{time.time():.8f}'
-        logger.info(f'Start running: {loop_id}')
-        while self.running:
-            i += 1
-            t = time.time()-tic
-
-            # Offset the time
-            t -= CONFIG.temporalDesign.startOffset
-
-            # Generate the frame img
-            img = self.generate_img(t)
-            # Put the img into pixmap
-            if self.running:
-                with self.acquire_lock():
-                    self.pixmap = QPixmap.fromImage(ImageQt(img))
-
-            # ! Sleep or not
-            # time.sleep(0.01)
-
-            # Report frame rate
-            if t > next_report_time:
-                print(f'Frame rate: {i/t:0.2f}')
-                next_report_time += next_report_time
-
-        logger.debug(f'Stopped running: {loop_id}')
+        if not self.running:
+            return
+
+        self._frame_count += 1
+        t = self._elapsed_timer.nsecsElapsed() * 1e-9
+
+        # Offset the time
+        t -= self._start_offset
+
+        # Generate the frame into the frame buffer if it is changed,
+        # and put the frame into pixmap, the QImage wraps the frame buffer without copying
+        key = self.frame_key(t)
+        if key is None or key != self._last_frame_key:
+            self._last_frame_key = key
+            self.generate_img(t)
+            self.frameReady.emit(QPixmap.fromImage(self._frame_qimg))
+
+        # Report frame rate
+        if t > self._next_report_time:
+            fps = (self._frame_count - self._report_count) / (t - self._report_t)
+            logger.info(f'Frame rate: {fps:0.2f}')
+            self._report_count = self._frame_count
+            self._report_t = t
+            self._next_report_time += self._report_interval
 
     def place_img(self, img: Image):
-        mat = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        mat[:, :, 3] = 255
+        # The opaque black background, filled by one word per pixel
+        mat = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        mat.view('<u4')[:] = 0xFF000000
         bg = Image.fromarray(mat, mode='RGBA')
 
         a1 = bg.width / bg.height
@@ -215,13 +250,19 @@ class OnScreenDisplay(object):
             bg.paste(img, (0, int((bg.height-img.height)/2)))
         logger.debug(f'Resized img: {img.size}')
 
-        self.pixmap = QPixmap.fromImage(ImageQt(bg))
+        mat = np.asarray(bg)
+        qimg = QImage(mat.data, self.width, self.height,
+                      4*self.width, QImage.Format.Format_RGBA8888)
+        self.frameReady.emit(QPixmap.fromImage(qimg))
 
 
 class SequenceStimuli(OnScreenDisplay):
     images_df: pd.DataFrame
     image_mode: str
 
+    # The samples per second of the alpha lookup table
+    alpha_sample_rate = 1000
+
     def __init__(self, images_df: pd.DataFrame, image_mode: str, debug=False):
         """
         Initialize the EccentricityMapping class, which inherits from OnScreenDisplay.
@@ -260,6 +301,9 @@ class SequenceStimuli(OnScreenDisplay):
         np.random.shuffle(CONFIG.focusPoint.colors)
         CONFIG.focusPoint.colors.append(c)
 
+        # The RGBA color of the focus point for the frames
+        self._focus_rgba = (*ImageColor.getrgb(CONFIG.focusPoint.colors[0]), 255)
+
         logger.debug(
             f'Changed focus point color from {c} to {CONFIG.focusPoint.colors[0]}')
 
@@ -287,45 +331,131 @@ class SequenceStimuli(OnScreenDisplay):
         self.trial_length = cis.paddingBefore + cis.paddingAfter + cis.duration
         self.t1 = cis.paddingBefore
         self.t2 = cis.paddingBefore + cis.duration
+        self._inv_trial_length = 1.0 / self.trial_length
+        # The (t, idx, alpha) of the last trial state, it is shared by the frame key and the frame
+        self._trial = (None, None, None)
         # Start the index of the image from the -1, it increases as the display goes
         self.idx = -1
+
+        # The configuration constants used by the frames,
+        # they are read once instead of looking up the config every frame.
+        self._focus_toggled = bool(CONFIG.focusPoint.toggled)
+        self._bg_rgba = tuple(cis.background)
+        self._debug_rgba = (*ImageColor.getrgb(CONFIG.colors.debugColor), 255)
+
+        self._prepare_alpha_lut()
+        self._prepare_frame_buffer()
+        return
+
+    def _prepare_frame_buffer(self):
+        '''
+        Prepare the persistent buffers of the frames.
+
+        The frame buffer is filled with the background once,
+        and only the box of the image inside the screen and the overlays are rewritten by the frames.
+        The frame QImage wraps the memory of the frame buffer without copying it,
+        so the only copy per frame is the QPixmap conversion.
+        '''
+        background = tuple(CONFIG.imgSequence.background)
+
+        self._frame_buf = np.empty(
+            (self.height, self.width, 4), dtype=np.uint8)
+        self._frame_buf[:] = background
+        self._frame_qimg = QImage(self._frame_buf.data, self.width, self.height,
+                                  4*self.width, QImage.Format.Format_RGBA8888)
+
+        # The box of the image, and its (y, x) origin
+        ox, oy = self.img_offsets
+        self._img_box = np.s_[oy:oy+CONFIG.imgSize.height,
+                              ox:ox+CONFIG.imgSize.width]
+        self._img_origin = (oy, ox)
+
+        # The opaque image of the plateau, it is cached when the image changes
+        self._plateau_buf = np.empty(
+            (CONFIG.imgSize.height, CONFIG.imgSize.width, 4), dtype=np.uint8)
+        self._plateau_idx = None
+
+        # Compile the blending kernel before the frames, on a scratch buffer
+        if self._n_imgs > 0:
+            blend_into(np.empty_like(self._frame_buf),
+                       self._img_arrays[0], 0, oy, ox)
+
+        # The box of the focus point, and the disc inside it.
+        # The focus point is inside the box of the image, so it is rewritten by the frames.
+        r = CONFIG.focusPoint.radius
+        cx = self.width // 2
+        cy = self.height // 2
+        self._focus_box = np.s_[cy-r:cy+r+1, cx-r:cx+r+1]
+        mgy, mgx = np.ogrid[-r:r+1, -r:r+1]
+        self._focus_disc = mgx*mgx + mgy*mgy <= r*r
+        return
+
+    def _prepare_alpha_lut(self):
+        '''
+        Prepare the lookup table of the alpha values over one trial.
+
+        The alpha curve is sampled by the alpha_sample_rate,
+        so the alpha value is looked up instead of computed every frame.
+        '''
+        beta = 50
+        n = int(np.ceil(self.trial_length * self.alpha_sample_rate))
+        ts = np.arange(n) / self.alpha_sample_rate
+
+        # On left edge of duration it rises, and on right edge of duration it falls
+        left = np.abs(ts-self.t1) < np.abs(ts-self.t2)
+        with np.errstate(over='ignore', invalid='ignore'):
+            e1 = np.exp((ts-self.t1)*beta)
+            e2 = np.exp((ts-self.t2)*beta)
+            rise = np.floor(e1 / (1+e1) * 255)
+            fall = np.ceil((1 - e2 / (1+e2)) * 255)
+        self._alpha_lut = np.where(left, rise, fall).astype(np.uint8)
         return
 
     def get_alpha(self, t):
         '''Return 0-255 alpha value for the given time t.'''
-        beta = 50
-        t %= self.trial_length
-
-        # On left edge of duration
-        if abs(t-self.t1) < abs(t-self.t2):
-            t -= self.t1
-            t *= beta
-            a = np.exp(t) / (1+np.exp(t))
-            return np.floor((a*255)).astype(np.uint8)
-        # On right edge of duration
-        else:
-            t -= self.t2
-            t *= beta
-            a = (1-np.exp(t) / (1+np.exp(t)))
-            return np.ceil(a*255).astype(np.uint8)
+        k = int((t % self.trial_length) * self.alpha_sample_rate)
+        return int(self._alpha_lut[min(k, len(self._alpha_lut)-1)])
+
+    def _trial_state(self, t):
+        '''
+        Return the (idx, alpha) of the image at the time (t), they are None before the start.
+        The last state is kept, so the frame key and the frame of the same time compute it once.
+        '''
+        if self._trial[0] != t:
+            if t > 0:
+                self._trial = (t, int(t * self._inv_trial_length), self.get_alpha(t))
+            else:
+                self._trial = (t, None, None)
+        return self._trial[1:]
+
+    @staticmethod
+    def _load_image(path: Path, size: tuple) -> np.ndarray:
+        '''
+        Read the image, resize it and convert it to the 'RGBA' uint8 array.
+        The image is decoded at once, and the file is closed when it is read.
+        '''
+        with Image.open(path) as img:
+            img.load()
+            return np.asarray(img.resize(size).convert('RGBA'), dtype=np.uint8)
 
     def read_images(self):
         # Read the images
         paths = mk_sequence_from_dataframe_nsd(self.images_df, self.image_mode)
-        imgs = [Image.open(p) for p in paths]
         names = ['{}-{}'.format(self.image_mode, p.name) for p in paths]
 
-        # Resize the images
+        # Read, resize and convert the images to 'RGBA' in parallel,
+        # the decoding releases the GIL.
         size = (CONFIG.imgSize.width, CONFIG.imgSize.height)
         # size = (self.width, self.height)
-        imgs = [e.resize((size)) for e in imgs]
-
-        # Convert the images to 'RGBA'
-        imgs = [e.convert('RGBA') for e in imgs]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            imgs = list(executor.map(
+                lambda p: self._load_image(p, size), paths))
 
         # Remember the images and names.
-        self.imgs = imgs
+        # The images are kept as the uint8 arrays at the display size for the frames.
+        self._img_arrays = imgs
         self.names = names
+        self._n_imgs = len(imgs)
 
         # Compute the img_offsets.
         # It is the left-top coordinate of the image inside the screen.
@@ -338,97 +468,114 @@ class SequenceStimuli(OnScreenDisplay):
         logger.debug(f'The images are {names}')
         return
 
-    def generate_img(self, t: float) -> Image.Image:
-        '''Implementation of the generate_img method'''
+    def frame_key(self, t: float):
+        '''
+        The key of the frame at the time (t).
+
+        The frame is decided by the image, its alpha, the focus point color and the debug progress bar in pixels.
+        The frame is always generated when the focus point color is due to change.
+        '''
+        if self._focus_toggled and t > self.t_next_change_focus_color:
+            return None
+
+        idx, alpha = self._trial_state(t)
+
+        progress = None
+        if self.debug:
+            progress = int(self.width * (t % self.trial_length) * self._inv_trial_length)
+
+        return (idx, alpha, self._focus_rgba, progress)
+
+    @staticmethod
+    def _draw_rect(buf: np.ndarray, x0: float, y0: float, x1: float, y1: float, color: tuple, fill: bool = True):
+        '''
+        Draw the axis-aligned rectangle into the buffer by the slices.
+
+        The corners are included, the same as the ImageDraw.rectangle does.
+        The outline is drawn by the four 1 pixel slices if not fill.
+        '''
+        x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+        if fill:
+            buf[y0:y1+1, x0:x1+1] = color
+            return
+        buf[y0, x0:x1+1] = color
+        buf[y1, x0:x1+1] = color
+        buf[y0:y1+1, x0] = color
+        buf[y0:y1+1, x1] = color
+
+    def generate_img(self, t: float) -> np.ndarray:
+        '''Implementation of the generate_img method, the frame is rendered into the frame buffer.'''
+        mat = self._frame_buf
+        W = self.width
+        tl = self.trial_length
+        t1 = self.t1
+        t2 = self.t2
 
         # Check the experiment progress.
-        if t > 0:
-            idx = int(t // self.trial_length)
-        else:
-            idx = None
+        idx, alpha = self._trial_state(t)
 
-        def get_and_prepare_img(idx, t):
+        def get_and_prepare_img(idx, alpha, t):
             if t > 0:
                 # Get the image and its name.
-                img = self.imgs[idx % len(self.imgs)].copy()
-                name = self.names[idx % len(self.names)]
+                j = idx % self._n_imgs
+                arr = self._img_arrays[j]
+                name = self.names[j]
 
                 # Trigger it out when the image displays on the screen.
                 if idx > self.idx:
                     self.idx = idx
                     logger.info(f'Display img: {idx} | {name}')
 
-                # Get and set the img's alpha channel.
-                alpha = self.get_alpha(t) / 255
-
                 # Now it only works with pure black background.
-                mat = np.array(img).astype(np.float32)
-                mat *= alpha
-                img = Image.fromarray(mat.astype(np.uint8), mode='RGBA')
-                img.putalpha(255)
-
-                # Paste the image into the center.
-                # The color is initialized from the imgSequence.background (r, g, b, a).
-                # mat = np.zeros((self.height, self.width, 4))
-                # mat[:, :] = CONFIG.imgSequence.background
-                # img_backer = Image.fromarray(mat.astype(np.uint8), mode='RGBA')
-                img_backer = Image.new(
-                    'RGBA', (self.width, self.height), (0, 0, 0, 255))
-                img_backer.paste(img, self.img_offsets)
+                # Put the image into the center of the frame buffer,
+                # the other pixels keep the imgSequence.background (r, g, b, a).
+                # The plateau and the padding are the cached image and the opaque black,
+                # only the edges are scaled by the alpha and put in a single pass by the kernel.
+                if alpha == 255:
+                    if self._plateau_idx != idx:
+                        np.copyto(self._plateau_buf, arr)
+                        self._plateau_buf[:, :, 3] = 255
+                        self._plateau_idx = idx
+                    mat[self._img_box] = self._plateau_buf
+                elif alpha == 0:
+                    mat[self._img_box] = (0, 0, 0, 255)
+                else:
+                    blend_into(mat, arr, alpha, *self._img_origin)
             else:
-                img_backer = Image.new(
-                    'RGBA', (self.width, self.height), (0, 0, 0, 255))
+                mat[self._img_box] = self._bg_rgba
                 name = 'Not start yet'
 
-            return img_backer, name
+            return name
 
-        def mk_bg_img():
-            # Generate the image and its drawing context.
-            # The initializing color is (0, 0, 0, 0) for all the pixels
-            # mat = np.zeros((self.height, self.width, 4))
-            # mat[:, :] = CONFIG.imgSequence.background
-            # bg_img = Image.fromarray(mat.astype(np.uint8), mode='RGBA')
-            bg_img = Image.new(
-                'RGBA', (self.width, self.height), (0, 0, 0, 255))
-            return bg_img
-
-        # Get the img and its background img
-        img, name = get_and_prepare_img(idx, t)
-        bg_img = mk_bg_img()
-
-        # Put the img on the top of bg_img,
-        # by compositing img and bg_img, the mask is img.
-        # So, the mask is used for alpha transparency.
-        img = Image.composite(img, bg_img, mask=img)
-        draw = ImageDraw.Draw(img)
+        # Put the img, it is opaque, so it is drawn without compositing on the background.
+        name = get_and_prepare_img(idx, alpha, t)
 
         # Debug display
         if self.debug:
+            color = self._debug_rgba
+
+            # Clear the previous progress bar, it is the top 11 rows
+            mat[:11] = self._bg_rgba
+
             # Display the progress bar
-            tt = t % self.trial_length
-            r1 = tt / self.trial_length
+            tt = t % tl
+            r1 = tt / tl
 
-            draw.rectangle(
-                (0, 0, self.width*r1, 10), outline=CONFIG.colors.debugColor)
+            self._draw_rect(mat, 0, 0, W*r1, 10, color, fill=False)
 
-            if tt > self.t1:
-                r21 = self.t1 / self.trial_length
-                r22 = min(tt, self.t2) / self.trial_length
-                draw.rectangle(
-                    (self.width*r21, 0, self.width*r22, 10), fill=CONFIG.colors.debugColor)
+            if tt > t1:
+                r21 = t1 / tl
+                r22 = min(tt, t2) / tl
+                self._draw_rect(mat, W*r21, 0, W*r22, 10, color)
 
         # Put the focus point on the center
-        if CONFIG.focusPoint.toggled:
+        if self._focus_toggled:
             if t > self.t_next_change_focus_color:
                 self.change_focus_color(t)
 
-            radius = CONFIG.focusPoint.radius
-            color = CONFIG.focusPoint.colors[0]
-            box = (
-                self.width//2-radius, self.height//2-radius, self.width//2+radius, self.height//2+radius)
-            draw.ellipse(box, fill=color)
+            mat[self._focus_box][self._focus_disc] = self._focus_rgba
 
-        return img
+        return mat
 
 
 # %% ---- 2024-11-01 ------------------------
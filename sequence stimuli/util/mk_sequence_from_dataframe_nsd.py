@@ -19,6 +19,7 @@ Functions:
 
 # %% ---- 2024-12-19 ------------------------
 # Requirements and constants
+import os
 import random
 import pandas as pd
 from pathlib import Path
@@ -45,16 +46,15 @@ def mk_sequence_from_dataframe_nsd(
         The sequence of stimuli.
     """
 
-    nds_names = df['nsdName']
-
-    if mode == 'colorful':
-        sequence = [nsd_folder.joinpath(
-            f'colorful/{name}.png') for name in nds_names]
-    elif mode == 'hed':
-        sequence = [nsd_folder.joinpath(
-            f'hed/{name}.png') for name in nds_names]
-    else:
+    # The sub folder of the images in the mode
+    subdirs = {'colorful': 'colorful', 'hed': 'hed'}
+    if mode not in subdirs:
         raise ValueError(f'Unknown mode: {mode}')
+
+    # Build the paths by the vectorized string operations of the names
+    folder = str(nsd_folder.joinpath(subdirs[mode]))
+    paths = folder + os.sep + df['nsdName'].astype(str) + '.png'
+    sequence = [Path(p) for p in paths]
     logger.info(f'Made sequence in mode: {mode}')
     logger.debug(f'Sequence is {sequence}')
 
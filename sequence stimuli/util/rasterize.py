@@ -0,0 +1,64 @@
+"""
+File: rasterize.py
+Author: Chuncheng Zhang
+Date: 2026-10-15
+Copyright & Email: chuncheng.zhang@ia.ac.cn
+
+Purpose:
+    Numba kernels for rasterizing the sequence stimuli into the RGBA buffer.
+
+Functions:
+    1. Requirements and constants
+    2. Function and class
+    3. Play ground
+    4. Pending
+    5. Pending
+"""
+
+
+# %% ---- 2026-10-15 ------------------------
+# Requirements and constants
+import numpy as np
+
+from numba import njit, prange
+
+
+# %% ---- 2026-10-15 ------------------------
+# Function and class
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def blend_into(dst: np.ndarray, src: np.ndarray, alpha: int, off_y: int, off_x: int):
+    """
+    Scale the image by the alpha and put it opaque into the RGBA buffer in a single pass.
+
+    The color channels are scaled as x*alpha//255 on the pure black background,
+    and the alpha channel is 255.
+    The rows are filled in parallel, and the GIL is released during the filling.
+
+    Args:
+        dst, ndarray: The (height, width, 4) uint8 RGBA buffer to fill.
+        src, ndarray: The (h, w, 4) uint8 RGBA image.
+        alpha, int: The 0-255 alpha value.
+        off_y, int: The top coordinate of the image inside the buffer.
+        off_x, int: The left coordinate of the image inside the buffer.
+    """
+    height, width = src.shape[0], src.shape[1]
+    for i in prange(height):
+        y = off_y + i
+        for j in range(width):
+            x = off_x + j
+            dst[y, x, 0] = src[i, j, 0] * alpha // 255
+            dst[y, x, 1] = src[i, j, 1] * alpha // 255
+            dst[y, x, 2] = src[i, j, 2] * alpha // 255
+            dst[y, x, 3] = 255
+
+
+# %% ---- 2026-10-15 ------------------------
+# Play ground
+
+
+# %% ---- 2026-10-15 ------------------------
+# Pending
+
+
+# %% ---- 2026-10-15 ------------------------
+# Pending